@@ -0,0 +1,20 @@
+import gc
+import os
+import sys
+
+# Swap in or roll back a code update before main.py is imported. Only
+# load the updater if ota.json says there is one.
+try:
+    os.stat('ota.json')
+    update = True
+except OSError:
+    update = False
+if update:
+    import ota
+    ota.boot()
+    # Stays loaded while its timer waits for main.py to confirm
+    if ota.timer is None:
+        del sys.modules['ota']
+    del ota
+del update
+gc.collect()
@@ -1,10 +1,21 @@
 import os
 import sys
 import json
+import time
+import hashlib
+import queue
+import wave
 import types
+import select
 import socket
+import struct
+import threading
 
 RECEIVE_LEN = 2048
+# Frames the stream reader may get ahead of the network by
+STREAM_BUFFER = 64
+# Set in a stream frame's length when it holds a control request
+STREAM_CONTROL = 0x8000
 
 class Client(object):
 
@@ -15,6 +26,25 @@ class Client(object):
         self.server = server
         self.s = socket.socket()
         self.server_methods = {}
+        # Control updates waiting to be sent, by action
+        self.pending = {}
+        # Control update sent but not yet acknowledged
+        self.in_flight = None
+        # While streaming control updates go inside the stream instead,
+        # these are shared with the thread calling stream(). Held from
+        # sending a request until its reply is read.
+        self.lock = threading.RLock()
+        self.stream_cond = threading.Condition(self.lock)
+        self.streaming = False
+        self.stream_controls = {}
+        self.stream_paused = False
+        self.stream_seekable = False
+        # Offset of the first sample and bytes per sample frame of a WAV
+        # being scaled by the device, seeks have to keep to its frames
+        self.stream_align = None
+        self.seek_to = None
+        # Bumped on every seek so frames read before it are dropped
+        self.generation = 0
 
     def discover(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
@@ -44,10 +74,13 @@ class Client(object):
         return self.s.send(json.dumps(msg).encode('utf-8'))
 
     def call(self, action, response=True, **kwargs):
-        kwargs['action'] = action
-        self.send(kwargs)
-        if response:
-            return self.response()
+        with self.lock:
+            # Keep replies in order, control updates go out first
+            self.wait_control()
+            kwargs['action'] = action
+            self.send(kwargs)
+            if response:
+                return self.response()
 
     def response(self):
         data = json.loads(self.s.recv(RECEIVE_LEN).decode('utf-8'))
@@ -55,6 +88,43 @@ class Client(object):
             raise Exception(data['error'])
         return data
 
+    def control(self, action, **kwargs):
+        '''
+        Sends a control update without waiting for the reply. While one
+        is unacknowledged newer updates for the same action replace each
+        other so only the latest is sent once the device catches up.
+        While streaming they are sent between audio frames instead.
+        '''
+        with self.lock:
+            if self.streaming:
+                self.stream_controls[action] = kwargs
+                return
+            self.pending[action] = kwargs
+            self.poll_control()
+
+    def poll_control(self, timeout=0):
+        '''
+        Collects a control acknowledgement if there is one and sends the
+        next pending update. Returns True once everything has been
+        acknowledged.
+        '''
+        if self.in_flight is not None:
+            readable, _, _ = select.select([self.s], [], [], timeout)
+            if not readable:
+                return False
+            self.in_flight = None
+            self.response()
+        if self.pending:
+            self.in_flight, kwargs = self.pending.popitem()
+            kwargs['action'] = self.in_flight
+            self.send(kwargs)
+            return False
+        return True
+
+    def wait_control(self):
+        while not self.poll_control(None):
+            pass
+
     def methods(self):
         '''
         methods()
@@ -87,19 +157,233 @@ class Client(object):
         '''
         self.call('wifi_reset', response=False)
 
-    def load_file(self, filename):
+    def set_volume(self, left, right=None):
         '''
-        load_file(filename)
+        set_volume(left, right)
+        '''
+        if right is None:
+            right = left
+        self.control('set_volume', left=left, right=right)
+
+    def set_bass_treble(self, bass, treble, **kwargs):
         '''
+        set_bass_treble(bass, treble)
+        '''
+        self.control('set_bass_treble', bass=bass, treble=treble, **kwargs)
+
+    def upload(self, action, filename, **kwargs):
         if not os.path.isfile(filename):
             raise Exception('%s is not a file' % (filename,))
-        self.call('load_file',
+        self.call(action,
                 filename=os.path.basename(filename),
-                length=os.stat(filename).st_size)
+                length=os.stat(filename).st_size,
+                **kwargs)
         with open(filename, 'rb') as fd:
             self.s.sendfile(fd)
         return self.response()
 
+    def load_file(self, filename):
+        '''
+        load_file(filename)
+        '''
+        return self.upload('load_file', filename)
+
+    def ota_update(self, *filenames):
+        '''
+        ota_update(filenames...)
+        '''
+        current = self.call('ota_manifest')
+        changed = []
+        for filename in filenames:
+            name = os.path.basename(filename)
+            if name in current['protected']:
+                print('Skipping', name, 'which can\'t be updated this way')
+                continue
+            with open(filename, 'rb') as fd:
+                digest = hashlib.sha256(fd.read()).hexdigest()
+            if current['files'].get(name) == digest:
+                continue
+            print('Sending', name)
+            self.upload('ota_file', filename, hash=digest)
+            changed.append(name)
+        if not changed:
+            print('Device is up to date')
+            return changed
+        # The device resets itself to install
+        self.call('ota_commit', files=changed)
+        return changed
+
+    def pause(self, paused=True):
+        '''
+        pause(paused)
+        '''
+        with self.lock:
+            if not self.streaming:
+                raise Exception('Can only pause while streaming')
+            self.stream_paused = paused
+            self.stream_controls['pause'] = {'paused': paused}
+
+    def seek(self, position):
+        '''
+        seek(position)
+        '''
+        with self.lock:
+            if not self.streaming:
+                raise Exception('Can only seek while streaming')
+            if not self.stream_seekable:
+                raise Exception('Can\'t seek in this stream')
+            if self.stream_align is not None:
+                start, block = self.stream_align
+                position = start + max(position - start, 0) // block * block
+            self.seek_to = position
+            self.generation += 1
+            self.stream_controls['seek'] = {'position': position}
+            self.stream_cond.notify_all()
+
+    def stream_reader(self, fd, frames):
+        while True:
+            with self.lock:
+                if self.seek_to is not None:
+                    fd.seek(self.seek_to)
+                    self.seek_to = None
+                generation = self.generation
+            data = fd.read(RECEIVE_LEN)
+            while True:
+                try:
+                    frames.put((generation, data), timeout=0.1)
+                    break
+                except queue.Full:
+                    if not self.streaming:
+                        return
+            if not data:
+                # Stay around in case of a seek back from the end
+                with self.stream_cond:
+                    while self.streaming and self.seek_to is None:
+                        self.stream_cond.wait()
+                    if not self.streaming:
+                        return
+
+    def send_stream_controls(self):
+        with self.lock:
+            controls = self.stream_controls
+            self.stream_controls = {}
+        for action, kwargs in controls.items():
+            kwargs['action'] = action
+            data = json.dumps(kwargs).encode('utf-8')
+            self.s.sendall(struct.pack('>H', STREAM_CONTROL | len(data))
+                    + data)
+
+    def stream(self, filename='-', gain=None, report=1.0):
+        '''
+        stream(filename)
+        '''
+        # Strings when given on the command line
+        report = float(report)
+        if gain is not None:
+            gain = int(gain)
+        if filename == '-':
+            fd = sys.stdin.buffer
+            name = 'stdin'
+        else:
+            fd = open(filename, 'rb')
+            name = os.path.basename(filename)
+        seekable = fd.seekable()
+        align = None
+        if gain is not None and seekable:
+            w = wave.open(fd)
+            # Left just past the data chunk's header
+            align = (fd.tell(), w.getnchannels() * w.getsampwidth())
+            fd.seek(0)
+        # Reading happens on its own thread so a slow network never
+        # stalls the producer until the buffer is full
+        frames = queue.Queue(STREAM_BUFFER)
+        reader = threading.Thread(target=self.stream_reader,
+                args=(fd, frames))
+        reader.daemon = True
+        with self.lock:
+            # Controls from other threads go in the stream from here on
+            if gain is None:
+                self.call('stream', name=name)
+            else:
+                self.call('stream', name=name, gain=gain)
+            self.streaming = True
+            self.stream_paused = False
+            self.stream_seekable = seekable
+            self.stream_align = align
+            if align is not None:
+                # Sent before anything can seek past it, the reader
+                # carries on from the first sample
+                header = fd.read(align[0])
+                for i in range(0, len(header), RECEIVE_LEN):
+                    data = header[i:i + RECEIVE_LEN]
+                    self.s.sendall(struct.pack('>H', len(data)) + data)
+        reader.start()
+        sent = 0
+        underruns = 0
+        dry = False
+        last_sent = 0
+        last_report = time.time()
+        try:
+            while True:
+                self.send_stream_controls()
+                # Hold audio back while paused, controls still go out
+                if self.stream_paused:
+                    time.sleep(0.05)
+                    continue
+                try:
+                    generation, data = frames.get(timeout=0.05)
+                except queue.Empty:
+                    # Ran dry after starting, the producer can't keep up
+                    if sent and not dry:
+                        underruns += 1
+                    dry = True
+                    continue
+                dry = False
+                with self.lock:
+                    # Read before the last seek
+                    if generation != self.generation:
+                        continue
+                    if not data:
+                        # Past the end, nothing left to seek in
+                        self.stream_seekable = False
+                self.s.sendall(struct.pack('>H', len(data)) + data)
+                if not data:
+                    break
+                sent += len(data)
+                now = time.time()
+                if now - last_report >= report:
+                    sys.stderr.write('%.1f KB/s, buffer %d/%d, %d underruns\n'
+                            % ((sent - last_sent) / (now - last_report) / 1024,
+                                frames.qsize(), STREAM_BUFFER, underruns))
+                    last_sent = sent
+                    last_report = now
+            result = self.response()
+        except OSError as e:
+            # The device hangs up on a stream it can't play, after saying
+            # why
+            try:
+                self.response()
+            except (OSError, ValueError):
+                pass
+            raise Exception('Device closed the stream: %s' % (e))
+        finally:
+            with self.lock:
+                self.streaming = False
+                self.stream_seekable = False
+                self.stream_align = None
+                self.seek_to = None
+                self.stream_cond.notify_all()
+                controls = self.stream_controls
+                self.stream_controls = {}
+            if fd is not sys.stdin.buffer:
+                reader.join()
+                fd.close()
+        # Controls that came in as the stream ended still apply
+        for action in ('set_volume', 'set_bass_treble'):
+            if action in controls:
+                self.control(action, **controls[action])
+        return result
+
 def main():
     c = Client(('192.168.254.43', 8080))
     # c = Client(('192.168.4.1', 8080))
@@ -109,6 +393,8 @@ def main():
         return
     if sys.argv[1] == '-h' or sys.argv[1] == '--help':
         c.list_methods()
+    elif sys.argv[1] == 'ota_update':
+        c.ota_update(*sys.argv[2:])
     else:
         f = None
         try:
@@ -129,6 +415,7 @@ def main():
                 else:
                     data[i] = True
             f(**data)
+    c.wait_control()
 
 if __name__ == '__main__':
     main()
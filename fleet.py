@@ -0,0 +1,129 @@
+import json
+import time
+import socket
+import argparse
+
+from client import Client, RECEIVE_LEN
+
+COLUMNS = ('address', 'uptime', 'free_heap', 'rssi', 'track', 'position',
+        'error')
+
+def discover(timeout):
+    '''
+    Pings the discovery group and collects every device that answers
+    within timeout seconds
+    '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+            socket.IPPROTO_UDP)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    s.sendto(b"ping", (Client.DISCOVERY_GROUP, Client.DISCOVERY_PORT))
+    servers = set()
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        s.settimeout(remaining)
+        try:
+            data, addr = s.recvfrom(5)
+        except socket.timeout:
+            break
+        try:
+            servers.add((addr[0], int(data)))
+        except ValueError:
+            pass
+    s.close()
+    return sorted(servers)
+
+def sweep(servers, timeout):
+    '''
+    Asks every server for its status at once, the sweep takes at most
+    timeout seconds however many there are. Status is asked for on the
+    discovery port, which devices answer even while a stream or another
+    client keeps their TCP server busy.
+    '''
+    deadline = time.time() + timeout
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+            socket.IPPROTO_UDP)
+    results = {}
+    # Replies only say which address they came from
+    waiting = {}
+    for server in servers:
+        try:
+            addr = socket.gethostbyname(server[0])
+            s.sendto(b"status", (addr, Client.DISCOVERY_PORT))
+        except OSError as e:
+            results[server] = {'address': '%s:%d' % server,
+                'error': str(e) or e.__class__.__name__}
+            continue
+        waiting.setdefault(addr, []).append(server)
+    while waiting:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        s.settimeout(remaining)
+        try:
+            data, addr = s.recvfrom(RECEIVE_LEN)
+        except socket.timeout:
+            break
+        except OSError:
+            # An ICMP error for one of the other devices
+            continue
+        for server in waiting.pop(addr[0], ()):
+            status = {'address': '%s:%d' % server}
+            try:
+                status.update(json.loads(data.decode('utf-8')))
+            except ValueError:
+                status['error'] = 'bad reply'
+            results[server] = status
+    s.close()
+    statuses = []
+    for server in servers:
+        if server in results:
+            statuses.append(results[server])
+        else:
+            statuses.append({'address': '%s:%d' % server,
+                'error': 'timed out'})
+    return statuses
+
+def fmt_table(statuses):
+    rows = [COLUMNS]
+    for status in statuses:
+        rows.append(tuple('' if status.get(k) is None else str(status[k])
+            for k in COLUMNS))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    return '\n'.join('  '.join(v.ljust(w) for v, w in zip(row, widths))
+            .rstrip() for row in rows)
+
+def parse_server(server):
+    if ':' in server:
+        host, port = server.rsplit(':', 1)
+        return (host, int(port))
+    return (server, 8080)
+
+def main():
+    parser = argparse.ArgumentParser(description='Poll every device at once')
+    parser.add_argument('servers', nargs='*', type=parse_server,
+            help='host[:port] of devices to poll as well as discovered ones,'
+            ' the port is only shown as status is asked for on the discovery'
+            ' port')
+    parser.add_argument('-t', '--timeout', type=float, default=1.0,
+            help='seconds a whole sweep may take')
+    parser.add_argument('-d', '--discover', type=float, default=0.5,
+            help='seconds to wait for discovery replies, 0 to skip')
+    parser.add_argument('-j', '--json', action='store_true',
+            help='print one JSON object per device instead of a table')
+    args = parser.parse_args()
+
+    servers = set(args.servers)
+    if args.discover > 0:
+        servers.update(discover(args.discover))
+    statuses = sweep(sorted(servers), args.timeout)
+    if args.json:
+        for status in statuses:
+            print(json.dumps(status))
+    else:
+        print(fmt_table(statuses))
+
+if __name__ == '__main__':
+    main()
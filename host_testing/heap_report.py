@@ -0,0 +1,81 @@
+'''
+heap_report.py
+Reports how much heap booting the server takes, and what each lazily
+loaded handler module adds the first time it is used
+
+    python heap_report.py [directory holding the main.py to measure]
+
+Under the MicroPython Unix port gc.mem_alloc() is used, which is close
+to what the device sees, and the device's main.py is measured by
+default. Under CPython tracemalloc stands in and host_testing/main.py is
+measured, its figures are only good for comparing two versions with each
+other. Compile first with python -m compileall or the compiler's own
+allocations get counted too.
+'''
+import gc
+import sys
+
+HERE = sys.path[0] or '.'
+
+try:
+    gc.mem_alloc
+    def used():
+        gc.collect()
+        return gc.mem_alloc()
+    KIND = 'gc.mem_alloc()'
+    DEFAULT = HERE + '/..'
+except AttributeError:
+    # The standard library dwarfs everything else on CPython, load what
+    # main.py uses up front so only our own allocations are counted
+    import os
+    import json
+    import time
+    import select
+    import socket
+    import hashlib
+    import threading
+    import binascii
+    import tracemalloc
+    tracemalloc.start()
+    def used():
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+    KIND = 'tracemalloc'
+    DEFAULT = HERE
+
+def report(label, before):
+    now = used()
+    print('%-22s %8d bytes' % (label, now - before))
+    return now
+
+def main():
+    if len(sys.argv) > 1:
+        sys.path.insert(0, sys.argv[1])
+    else:
+        sys.path.insert(0, DEFAULT)
+    # The fakes for the device only modules
+    if HERE not in sys.path:
+        sys.path.append(HERE)
+    print('Heap used, measured with', KIND)
+    start = used()
+    now = start
+    import main
+    now = report('import main', now)
+    app = main.App()
+    now = report('App()', now)
+    print('%-22s %8d bytes' % ('boot total', now - start))
+    if not hasattr(app, 'load_handler'):
+        return
+    app.load_handler('set_volume')
+    now = report('playback handlers', now)
+    try:
+        app.codec()
+        now = report('codec driver', now)
+    except Exception as e:
+        # The Unix port's own machine module has no SPI
+        print('codec driver', e)
+    app.load_handler('ota_manifest')
+    now = report('ota handlers', now)
+
+if __name__ == '__main__':
+    main()
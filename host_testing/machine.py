@@ -3,6 +3,57 @@ machine.py
 Fakes the functions in micropython machine libary for testing on host
 '''
 import sys
+import threading
 
 def reset():
     sys.exit(0)
+
+class Pin(object):
+
+    IN = 0
+    OUT = 1
+
+    def __init__(self, pin, mode=IN, value=None):
+        self.pin = pin
+        self.mode = mode
+        # DREQ reads high so the codec always looks ready
+        self.val = 1 if value is None else value
+
+    def __call__(self, value=None):
+        if value is not None:
+            self.val = value
+        return self.val
+
+class SPI(object):
+
+    def __init__(self, spi, **kwargs):
+        self.spi = spi
+
+    def write(self, buf):
+        return
+
+    def write_readinto(self, write_buf, read_buf):
+        return
+
+class Timer(object):
+    '''
+    Calls back on a thread, only one shot timers are needed
+    '''
+
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id):
+        self.id = id
+        self.t = None
+
+    def init(self, period=-1, mode=PERIODIC, callback=None):
+        self.deinit()
+        self.t = threading.Timer(period / 1000, callback, args=(self,))
+        self.t.daemon = True
+        self.t.start()
+
+    def deinit(self):
+        if self.t is not None:
+            self.t.cancel()
+            self.t = None
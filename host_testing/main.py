@@ -1,11 +1,22 @@
 import gc
+import os
+import sys
 import esp
 import time
 import json
+import select
 import socket
 import network
 import machine
+import threading
 
+# Modules shared with the device live in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PIN_XDCS = 15
+PIN_DREQ = 0
+PIN_MP3CS = 16
+PIN_SD_CS = 2
 RECEIVE_LEN = 2048
 AP_CONFIG_DEFAULT = {
         'essid': 'FEADFACE',
@@ -17,6 +28,9 @@ AP_CONFIG_DEFAULT = {
 DEFAULT_PORT = 8080
 DISCOVERY_GROUP = '224.1.1.1'
 DISCOVERY_PORT = 45362
+BOOT_START = time.time()
+RESPONSE_OK = json.dumps({"error": False})
+RESPONSE_NO_METHOD = json.dumps({"error": "no such method"})
 
 class Config(object):
     '''
@@ -193,30 +207,46 @@ class WiFi(object):
                 return True
         return False
 
+class Connection(object):
+    '''
+    MicroPython sockets will send str as well as bytes, CPython's only
+    take bytes
+    '''
+
+    def __init__(self, c):
+        self.c = c
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self.c.send(data)
+
+    def readinto(self, buf, nbytes):
+        return self.c.recv_into(buf, nbytes)
+
+    def __getattr__(self, name):
+        return getattr(self.c, name)
+
 class App(object):
 
-    METHODS = {
-            'methods': {
-                'args': [],
-                'response': True,
-                },
-            'reset': {
-                'args': [],
-                'response': False,
-                },
-            'wifi_add': {
-                'args': ['ssid', 'password', 'hidden'],
-                'response': False,
-                },
-            'wifi_reset': {
-                'args': [],
-                'response': False,
-                },
-            'load_file': {
-                'args': ['filename', 'length'],
-                'response': False,
-                }
-            }
+    # (action, args, response, module) kept as tuples rather than dicts of
+    # dicts, handle_methods expands them for the client on request.
+    # Handlers living in a module are only imported the first time their
+    # action is called.
+    METHODS = (
+            ('methods', (), True, None),
+            ('reset', (), False, None),
+            ('wifi_add', ('ssid', 'password', 'hidden'), False, None),
+            ('wifi_reset', (), False, None),
+            ('load_file', ('filename', 'length'), False, None),
+            ('set_volume', ('left', 'right'), False, 'playback'),
+            ('set_bass_treble', ('bass', 'treble'), False, 'playback'),
+            ('stream', (), False, 'playback'),
+            ('status', (), True, None),
+            ('ota_manifest', (), True, 'ota'),
+            ('ota_file', ('filename', 'length', 'hash'), False, 'ota'),
+            ('ota_commit', ('files',), True, 'ota'),
+            )
 
     def __init__(self):
         self.config = Config()
@@ -225,6 +255,17 @@ class App(object):
         if self.config.get('disable_debug'):
             esp.osdebug(None)
         self.wifi = WiFi(self.config)
+        self.vs1053 = None
+        self.track = None
+        self.d = None
+        # Resolve every action to its handler once so serving a request is
+        # a single dict lookup, handlers called as f(app, req, c)
+        self.dispatch = {}
+        for action, args, response, module in self.METHODS:
+            f = None
+            if module is None:
+                f = getattr(App, 'handle_' + action)
+            self.dispatch[action] = (f, args, response, module)
         self.serve = False
 
     def socket_reset(self):
@@ -234,14 +275,73 @@ class App(object):
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.s.bind(addr)
         self.s.listen(1)
+        self.discovery_reset()
+
+    def discovery_reset(self):
+        # Answer pings and status requests sent to the discovery group
+        if self.d is not None:
+            self.d.close()
+        self.d = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.d.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.d.bind(('0.0.0.0', DISCOVERY_PORT))
+        try:
+            mreq = socket.inet_aton(DISCOVERY_GROUP) \
+                    + socket.inet_aton('0.0.0.0')
+            self.d.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    mreq)
+        except OSError as e:
+            # Still answers status sent straight to us
+            print('Not joining discovery group:', e)
+        t = threading.Thread(target=self.discovery_handler, args=(self.d,))
+        t.daemon = True
+        t.start()
+
+    def discovery_handler(self, s):
+        while True:
+            try:
+                data, addr = s.recvfrom(16)
+            except OSError:
+                # Closed by socket_reset
+                return
+            if data == b'ping':
+                s.sendto(str(DEFAULT_PORT).encode('utf-8'), addr)
+            elif data == b'status':
+                s.sendto(json.dumps(self.status()).encode('utf-8'), addr)
+
+    def poll_discovery(self):
+        # Answered on its own thread
+        return
 
     def needs(self, d, *args):
         for a in args:
             if not a in d:
                 raise Exception('Missing \'%s\' field' % (a))
 
+    def codec(self):
+        '''
+        Loads the codec driver the first time playback is touched
+        '''
+        if self.vs1053 is None:
+            import vs1053
+            self.vs1053 = vs1053.VS1053(PIN_MP3CS, PIN_XDCS, PIN_DREQ)
+        return self.vs1053
+
+    def readable(self, poller):
+        return len(poller.poll(0)) > 0
+
+    def load_handler(self, action):
+        '''
+        Imports the module holding an action's handler and keeps the
+        handler for the next time
+        '''
+        f, args, response, module = self.dispatch[action]
+        f = getattr(__import__(module), 'handle_' + action)
+        self.dispatch[action] = (f, args, response, None)
+        return f
+
     def handle_methods(self, req, c):
-        c.send(json.dumps(self.METHODS))
+        c.send(json.dumps({m[0]: {'args': m[1], 'response': m[2]}
+            for m in self.METHODS}))
 
     def handle_reset(self, req, c):
         self.serve = False
@@ -255,13 +355,12 @@ class App(object):
         self.socket_reset()
         print('socket reset', self.s)
 
-    def handle_load_file(self, req, c):
-        self.needs(req, 'filename', 'length')
+    def receive_file(self, c, filename, length):
         received_length = 0
-        with open(req['filename'], 'wb') as fd:
+        with open(filename, 'wb') as fd:
             c.send(json.dumps({"ready": True}))
-            while received_length < req['length']:
-                still_need = req['length'] - received_length
+            while received_length < length:
+                still_need = length - received_length
                 if (still_need % RECEIVE_LEN) == 0:
                     still_need = RECEIVE_LEN
                 else:
@@ -272,32 +371,68 @@ class App(object):
                 fd.write(data)
                 received_length += len(data)
 
+    def handle_load_file(self, req, c):
+        self.needs(req, 'filename', 'length')
+        self.receive_file(c, req['filename'], req['length'])
+
+    def status(self):
+        return {
+            'uptime': int(time.time() - BOOT_START),
+            'free_heap': None,
+            'rssi': self.wifi.sta.status('rssi'),
+            'track': self.track,
+            'position': None if self.vs1053 is None else self.vs1053.position,
+            }
+
+    def handle_status(self, req, c):
+        c.send(json.dumps(self.status()))
+
     def main(self):
         self.wifi.reset()
         self.socket_reset()
+        # We made it to serving so any update we are running is good
+        try:
+            os.stat('ota.json')
+            update = True
+        except OSError:
+            update = False
+        if update:
+            import ota
+            ota.confirm()
         # Serve until we are told to reset
         self.serve = True
         while self.serve is not False:
             c, addr = self.s.accept()
+            c = Connection(c)
             print('Connection from', addr)
+            # Built once, requests come in too fast to allocate one each
+            poller = select.poll()
+            poller.register(c, select.POLLIN)
             while True:
                 try:
+                    # Apply only the latest of a burst of control updates, once the
+                    # client has nothing more queued up
+                    if self.vs1053 is not None and self.vs1053.pending \
+                            and not self.readable(poller):
+                        self.vs1053.flush()
                     req = c.recv(RECEIVE_LEN)
                     print('Request', req)
                     if len(req) == 0:
                         break
                     req = json.loads(req)
                     self.needs(req, 'action')
-                    if not req['action'] in self.METHODS:
-                        c.send(json.dumps({"error": "no such method"}))
+                    m = self.dispatch.get(req['action'])
+                    if m is None:
+                        c.send(RESPONSE_NO_METHOD)
                     else:
-                        m = self.METHODS[req['action']]
-                        self.needs(req, *m['args'])
-                        f = getattr(self,
-                                'handle_' + req['action'])
-                        f(req, c)
-                        if not m['response']:
-                            c.send(json.dumps({"error": False}))
+                        f, args, response, module = m
+                        if args:
+                            self.needs(req, *args)
+                        if f is None:
+                            f = self.load_handler(req['action'])
+                        f(self, req, c)
+                        if not response:
+                            c.send(RESPONSE_OK)
                 except Exception as e:
                     print('Error while serving request:', e)
                     try:
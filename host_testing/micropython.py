@@ -0,0 +1,7 @@
+'''
+micropython.py
+Fakes the functions in micropython micropython libary for testing on host
+'''
+
+def const(value):
+    return value
@@ -21,7 +21,9 @@ class WLAN(object):
             self.isactive = isactive
         return self.isactive
 
-    def status(self):
+    def status(self, param=None):
+        if param == 'rssi':
+            return -60
         return STAT_GOT_IP
 
     def ifconfig(self):
@@ -0,0 +1,127 @@
+'''
+test_playback.py
+Checks the WAV chunk walker and the carrying of sample frames split
+between stream frames
+
+    python -m unittest test_playback
+'''
+import os
+import sys
+import random
+import struct
+import unittest
+
+# Modules shared with the device live in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pcm
+import playback
+
+class Codec(object):
+
+    def __init__(self):
+        self.out = bytearray()
+
+    def sdi_write(self, data):
+        self.out += bytes(data)
+
+def make_wav(samples, channels=2, bits=16, extra=()):
+    '''
+    A WAV holding samples with the chunks in extra between fmt and data
+    '''
+    data = struct.pack('<%dh' % (len(samples)), *samples)
+    body = b'WAVE' + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels,
+            44100, 44100 * channels * bits // 8, channels * bits // 8, bits)
+    for cid, payload in extra:
+        body += cid + struct.pack('<I', len(payload)) + payload
+        if len(payload) & 1:
+            body += b'\0'
+    body += b'data' + struct.pack('<I', len(data)) + data
+    wav = b'RIFF' + struct.pack('<I', len(body)) + body
+    return wav, len(wav) - len(data)
+
+def play(wav, gain, sizes):
+    '''
+    Feeds wav through a Wav in frames of the sizes given, in turn
+    '''
+    w = playback.Wav(gain)
+    codec = Codec()
+    i = 0
+    n = 0
+    while i < len(wav):
+        length = min(sizes[n % len(sizes)], len(wav) - i)
+        w.play(codec, memoryview(bytearray(wav[i:i + length])), length)
+        i += length
+        n += 1
+    w.finish(codec)
+    return codec.out
+
+def unpack(data):
+    return struct.unpack('<%dh' % (len(data) // 2), bytes(data))
+
+# ffmpeg puts one of these between fmt and data
+LIST_INFO = (b'LIST', b'INFOISFT\x0e\x00\x00\x00Lavf60.16.100\x00')
+
+class TestChunks(unittest.TestCase):
+
+    def test_header_passed_through(self):
+        for extra in ((), (LIST_INFO,), ((b'odd ', b'abc'), LIST_INFO)):
+            wav, header = make_wav([1000] * 2000, extra=extra)
+            for sizes in ((1,), (3,), (7, 40), (2048,)):
+                out = play(wav, pcm.UNITY, sizes)
+                self.assertEqual(len(out), len(wav))
+                self.assertEqual(out[:header], wav[:header])
+
+    def test_channels_from_fmt(self):
+        for channels in (1, 2, 3):
+            wav, header = make_wav([1000] * 600, channels=channels)
+            w = playback.Wav(pcm.UNITY)
+            w.play(Codec(), memoryview(bytearray(wav)), len(wav))
+            self.assertEqual(w.channels, channels)
+
+    def test_refused(self):
+        wav, header = make_wav([0] * 100, bits=8)
+        with self.assertRaises(Exception):
+            play(wav, pcm.UNITY, (2048,))
+        with self.assertRaises(Exception):
+            play(b'ID3' + bytes(100), pcm.UNITY, (2048,))
+        for gain in (-1, pcm.GAIN_MAX + 1):
+            with self.assertRaises(Exception):
+                playback.Wav(gain)
+
+class TestCarry(unittest.TestCase):
+
+    def test_aligned_for_any_split(self):
+        rnd = random.Random(1)
+        for channels in (1, 2, 3):
+            samples = [rnd.randint(-32768, 32767)
+                    for _ in range(channels * 1000)]
+            wav, header = make_wav(samples, channels=channels,
+                    extra=(LIST_INFO,))
+            ramp = playback.RAMP_FRAMES * channels
+            for sizes in ((1,), (3,), (5, 7), (333,), (2048,),
+                    [rnd.randint(1, 64) for _ in range(50)]):
+                out = unpack(play(wav, pcm.UNITY // 2, sizes)[header:])
+                self.assertEqual(out[ramp:],
+                        tuple(s >> 1 for s in samples[ramp:]))
+
+    def test_ramp_spans_frames(self):
+        samples = [16384] * (2 * 600)
+        wav, header = make_wav(samples)
+        expected = unpack(play(wav, pcm.UNITY, (len(wav),))[header:])
+        # Starts from silence and rises steadily however it is split
+        self.assertEqual(expected[0], 0)
+        self.assertEqual(list(expected), sorted(expected))
+        self.assertEqual(expected[-1], 16384)
+        for sizes in ((1,), (3,), (4,), (50,)):
+            out = unpack(play(wav, pcm.UNITY, sizes)[header:])
+            self.assertEqual(out, expected)
+
+    def test_partial_frame_at_end(self):
+        wav, header = make_wav([1000] * 20)
+        out = play(wav + b'\x01\x02\x03', pcm.UNITY, (5,))
+        self.assertEqual(len(out), len(wav) + 3)
+        self.assertEqual(out[-3:], b'\x01\x02\x03')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,26 @@
 import gc
+import os
 import esp
 import time
 import json
+import select
 import socket
 import network
-import machine
+from micropython import const
 
-PIN_XDCS = 15
-PIN_DREQ = 0
-PIN_MP3CS = 16
-PIN_SD_CS = 2
-RECEIVE_LEN = 2048
+# Collect whatever the imports left behind before anything long lived
+# is allocated, the heap we have at boot decides how big the audio
+# buffers can be
+gc.collect()
+BOOT_START = time.ticks_ms()
+# Uptime is counted from here, ticks_ms wraps after a few days
+BOOT_TIME = time.time()
+
+PIN_XDCS = const(15)
+PIN_DREQ = const(0)
+PIN_MP3CS = const(16)
+PIN_SD_CS = const(2)
+RECEIVE_LEN = const(2048)
 AP_CONFIG_DEFAULT = {
         'essid': 'FEADFACE',
         'channel': 11,
@@ -18,9 +28,11 @@ AP_CONFIG_DEFAULT = {
         'authmode': network.AUTH_WPA2_PSK,
         'password': 'DEADBEEF'
         }
-DEFAULT_PORT = 8080
+DEFAULT_PORT = const(8080)
 DISCOVERY_GROUP = '224.1.1.1'
-DISCOVERY_PORT = 45362
+DISCOVERY_PORT = const(45362)
+RESPONSE_OK = json.dumps({"error": False})
+RESPONSE_NO_METHOD = json.dumps({"error": "no such method"})
 
 class Config(object):
     '''
@@ -199,28 +211,24 @@ class WiFi(object):
 
 class App(object):
 
-    METHODS = {
-            'methods': {
-                'args': [],
-                'response': True,
-                },
-            'reset': {
-                'args': [],
-                'response': False,
-                },
-            'wifi_add': {
-                'args': ['ssid', 'password', 'hidden'],
-                'response': False,
-                },
-            'wifi_reset': {
-                'args': [],
-                'response': False,
-                },
-            'load_file': {
-                'args': ['filename', 'length'],
-                'response': False,
-                }
-            }
+    # (action, args, response, module) kept as tuples rather than dicts of
+    # dicts, handle_methods expands them for the client on request.
+    # Handlers living in a module are only imported the first time their
+    # action is called.
+    METHODS = (
+            ('methods', (), True, None),
+            ('reset', (), False, None),
+            ('wifi_add', ('ssid', 'password', 'hidden'), False, None),
+            ('wifi_reset', (), False, None),
+            ('load_file', ('filename', 'length'), False, None),
+            ('set_volume', ('left', 'right'), False, 'playback'),
+            ('set_bass_treble', ('bass', 'treble'), False, 'playback'),
+            ('stream', (), False, 'playback'),
+            ('status', (), True, None),
+            ('ota_manifest', (), True, 'ota'),
+            ('ota_file', ('filename', 'length', 'hash'), False, 'ota'),
+            ('ota_commit', ('files',), True, 'ota'),
+            )
 
     def __init__(self):
         self.config = Config()
@@ -229,6 +237,17 @@ class App(object):
         if self.config.get('disable_debug'):
             esp.osdebug(None)
         self.wifi = WiFi(self.config)
+        self.vs1053 = None
+        self.track = None
+        self.d = None
+        # Resolve every action to its handler once so serving a request is
+        # a single dict lookup, handlers called as f(app, req, c)
+        self.dispatch = {}
+        for action, args, response, module in self.METHODS:
+            f = None
+            if module is None:
+                f = getattr(App, 'handle_' + action)
+            self.dispatch[action] = (f, args, response, module)
 
     def socket_reset(self):
         # Start the TCP server
@@ -240,16 +259,93 @@ class App(object):
         self.s.bind(addr)
         self.s.listen(1)
         self.s.setsockopt(socket.SOL_SOCKET, 20, self.accept_handler)
+        self.discovery_reset()
+
+    def discovery_reset(self):
+        # Answer pings and status requests sent to the discovery group
+        if self.d is not None:
+            self.d.close()
+        self.d = None
+        gc.collect()
+        try:
+            self.d = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.d.bind(socket.getaddrinfo('0.0.0.0', DISCOVERY_PORT)[0][-1])
+            mreq = bytes(int(x) for x in DISCOVERY_GROUP.split('.')) \
+                    + bytes(4)
+            self.d.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    mreq)
+            self.d.setblocking(False)
+            self.d.setsockopt(socket.SOL_SOCKET, 20, self.discovery_handler)
+        except OSError as e:
+            print('Discovery unavailable:', e)
+            self.d = None
+            return
+        self.discovery_poller = select.poll()
+        self.discovery_poller.register(self.d, select.POLLIN)
+
+    def discovery_handler(self, s):
+        try:
+            data, addr = self.d.recvfrom(16)
+        except OSError:
+            # Already answered from poll_discovery
+            return
+        if data == b'ping':
+            self.d.sendto(str(DEFAULT_PORT), addr)
+        elif data == b'status':
+            self.d.sendto(json.dumps(self.status()), addr)
+
+    def poll_discovery(self):
+        '''
+        The discovery callback can't run while a connection is being
+        served, long running handlers call this to answer it anyway
+        '''
+        if self.d is not None:
+            for s, event in self.discovery_poller.ipoll(0):
+                self.discovery_handler(s)
 
     def needs(self, d, *args):
         for a in args:
             if not a in d:
                 raise Exception('Missing \'%s\' field' % (a))
 
+    def codec(self):
+        '''
+        Loads the codec driver the first time playback is touched
+        '''
+        if self.vs1053 is None:
+            import vs1053
+            self.vs1053 = vs1053.VS1053(PIN_MP3CS, PIN_XDCS, PIN_DREQ)
+        return self.vs1053
+
+    def ready(self, poller, c, timeout):
+        '''
+        True if c became readable within timeout ms, discovery requests
+        coming in meanwhile are answered as the discovery callback can't
+        run while a connection is being served
+        '''
+        for s, event in poller.ipoll(timeout):
+            if s is c:
+                return True
+            self.discovery_handler(s)
+        return False
+
+    def load_handler(self, action):
+        '''
+        Imports the module holding an action's handler and keeps the
+        handler for the next time
+        '''
+        f, args, response, module = self.dispatch[action]
+        f = getattr(__import__(module), 'handle_' + action)
+        self.dispatch[action] = (f, args, response, None)
+        return f
+
     def handle_methods(self, req, c):
-        c.send(json.dumps(self.METHODS))
+        c.send(json.dumps({m[0]: {'args': m[1], 'response': m[2]}
+            for m in self.METHODS}))
 
     def handle_reset(self, req, c):
+        # Only needed on the way down so don't hold it in RAM until then
+        import machine
         self.s.close()
         machine.reset()
 
@@ -262,13 +358,12 @@ class App(object):
         self.socket_reset()
         print('socket reset', self.s)
 
-    def handle_load_file(self, req, c):
-        self.needs(req, 'filename', 'length')
+    def receive_file(self, c, filename, length):
         received_length = 0
-        with open(req['filename'], 'wb') as fd:
+        with open(filename, 'wb') as fd:
             c.send(json.dumps({"ready": True}))
-            while received_length < req['length']:
-                still_need = req['length'] - received_length
+            while received_length < length:
+                still_need = length - received_length
                 if (still_need % RECEIVE_LEN) == 0:
                     still_need = RECEIVE_LEN
                 else:
@@ -279,31 +374,73 @@ class App(object):
                 fd.write(data)
                 received_length += len(data)
 
+    def handle_load_file(self, req, c):
+        self.needs(req, 'filename', 'length')
+        self.receive_file(c, req['filename'], req['length'])
+
+    def status(self):
+        return {
+            'uptime': time.time() - BOOT_TIME,
+            'free_heap': gc.mem_free(),
+            'rssi': self.wifi.sta.status('rssi')
+                if self.wifi.sta.isconnected() else None,
+            'track': self.track,
+            'position': None if self.vs1053 is None else self.vs1053.position,
+            }
+
+    def handle_status(self, req, c):
+        c.send(json.dumps(self.status()))
+
     def main(self):
         self.wifi.reset()
         self.socket_reset()
+        # We made it to serving so any update we are running is good
+        try:
+            os.stat('ota.json')
+            update = True
+        except OSError:
+            update = False
+        if update:
+            import ota
+            ota.confirm()
+        print('Booted in', time.ticks_diff(time.ticks_ms(), BOOT_START),
+                'ms with', gc.mem_free(), 'bytes free')
 
     def accept_handler(self, s):
         c, addr = self.s.accept()
         print('Connection from', addr)
+        # Built once, requests come in too fast to allocate one each
+        poller = select.poll()
+        poller.register(c, select.POLLIN)
+        if self.d is not None:
+            poller.register(self.d, select.POLLIN)
         while True:
             try:
+                # Apply only the latest of a burst of control updates, once the
+                # client has nothing more queued up
+                if self.vs1053 is not None and self.vs1053.pending \
+                        and not self.ready(poller, c, 0):
+                    self.vs1053.flush()
+                while not self.ready(poller, c, -1):
+                    pass
                 req = c.recv(RECEIVE_LEN)
                 print('Request', req)
                 if len(req) == 0:
                     break
                 req = json.loads(req)
                 self.needs(req, 'action')
-                if not req['action'] in self.METHODS:
-                    c.send(json.dumps({"error": "no such method"}))
+                m = self.dispatch.get(req['action'])
+                if m is None:
+                    c.send(RESPONSE_NO_METHOD)
                 else:
-                    m = self.METHODS[req['action']]
-                    self.needs(req, *m['args'])
-                    f = getattr(self,
-                            'handle_' + req['action'])
-                    f(req, c)
-                    if not m['response']:
-                        c.send(json.dumps({"error": False}))
+                    f, args, response, module = m
+                    if args:
+                        self.needs(req, *args)
+                    if f is None:
+                        f = self.load_handler(req['action'])
+                    f(self, req, c)
+                    if not response:
+                        c.send(RESPONSE_OK)
             except Exception as e:
                 print('Error while serving request:', e)
                 try:
@@ -319,5 +456,4 @@ def main():
     app.main()
 
 if __name__ == '__main__':
-    gc.collect()
     main()
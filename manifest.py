@@ -0,0 +1,26 @@
+# Modules frozen into the firmware, build with
+#   make BOARD=GENERIC FROZEN_MANIFEST=/path/to/audio/manifest.py
+# Files of the same name on the filesystem come first on sys.path, so
+# ota_update can still replace a frozen module.
+import os
+import hashlib
+
+FROZEN = ('vs1053.py', 'pcm.py', 'playback.py')
+
+# Older builds run this from its own directory, newer ones say where it is
+here = os.path.dirname(globals().get('__file__', 'manifest.py'))
+
+# The frozen modules' hashes go in the firmware too, so ota_update only
+# sends the ones that changed
+hashes = {}
+for name in FROZEN:
+    with open(os.path.join(here, name), 'rb') as fd:
+        hashes[name] = hashlib.sha256(fd.read()).hexdigest()
+with open(os.path.join(here, 'frozen_hashes.py'), 'w') as fd:
+    fd.write('# Written by manifest.py, hashes of the modules it froze\n')
+    fd.write('HASHES = %r\n' % (hashes,))
+
+include("$(PORT_DIR)/boards/manifest.py")
+for name in FROZEN:
+    module(name)
+module("frozen_hashes.py")
@@ -0,0 +1,192 @@
+'''
+ota.py
+Stages code updates next to the running code, swaps them in on boot and
+swaps them back out if the new code never reaches the serving state
+'''
+import os
+import json
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+try:
+    import binascii
+except ImportError:
+    import ubinascii as binascii
+
+STAGE_DIR = 'ota_new'
+BACKUP_DIR = 'ota_old'
+STATE_FILE = 'ota.json'
+# How long new code has to start serving before we roll back
+TRIAL_MS = 60000
+HASH_CHUNK = 512
+# Files the swap itself runs from, a bad copy could never be rolled back,
+# and the hashes of what manifest.py froze into the firmware
+PROTECTED = (STATE_FILE, 'ota.py', 'boot.py', 'frozen_hashes.py')
+# Resets us if new code never confirms, held here so it isn't collected
+timer = None
+
+def exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+def mkdir(path):
+    if not exists(path):
+        os.mkdir(path)
+
+def check_name(name):
+    '''
+    Only files in the top directory can be updated, and not the ones
+    that do the updating
+    '''
+    if not name or '/' in name or name in ('.', '..') or name in PROTECTED:
+        raise Exception('Can\'t update \'%s\'' % (name))
+    return name
+
+def hash_file(path):
+    h = hashlib.sha256()
+    buf = bytearray(HASH_CHUNK)
+    mv = memoryview(buf)
+    with open(path, 'rb') as fd:
+        while True:
+            n = fd.readinto(buf)
+            if not n:
+                break
+            h.update(mv[:n])
+    return binascii.hexlify(h.digest()).decode('utf-8')
+
+def manifest():
+    '''
+    Hashes of the code currently on the device that can be updated, a
+    module frozen into the firmware is reported unless a copy on the
+    filesystem is imported instead. Also lists the files that can't be.
+    '''
+    try:
+        from frozen_hashes import HASHES
+        files = dict(HASHES)
+    except ImportError:
+        files = {}
+    for name in os.listdir():
+        if name.endswith('.py') and not name in PROTECTED:
+            files[name] = hash_file(name)
+    return {'files': files, 'protected': PROTECTED}
+
+def stage_path(name):
+    mkdir(STAGE_DIR)
+    return STAGE_DIR + '/' + check_name(name)
+
+def verify(name, digest):
+    '''
+    Removes a staged file if it isn't what the client sent
+    '''
+    path = stage_path(name)
+    if hash_file(path) != digest:
+        os.remove(path)
+        raise Exception('Hash mismatch for \'%s\'' % (name))
+
+def load_state():
+    try:
+        with open(STATE_FILE, 'r') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+def save_state(state):
+    with open(STATE_FILE, 'w') as fd:
+        fd.write(json.dumps(state))
+
+def commit(names):
+    '''
+    Marks staged files to be swapped in on the next boot
+    '''
+    for name in names:
+        if not exists(stage_path(name)):
+            raise Exception('\'%s\' was never staged' % (name))
+    save_state({'state': 'pending', 'files': names})
+
+def swap(names):
+    # Safe to repeat if power is lost part way, files already moved
+    # are no longer in the stage directory
+    mkdir(BACKUP_DIR)
+    for name in names:
+        staged = STAGE_DIR + '/' + name
+        if not exists(staged):
+            continue
+        if exists(name):
+            os.rename(name, BACKUP_DIR + '/' + name)
+        os.rename(staged, name)
+
+def rollback(names):
+    for name in names:
+        backup = BACKUP_DIR + '/' + name
+        if exists(backup):
+            if exists(name):
+                os.remove(name)
+            os.rename(backup, name)
+        elif exists(name):
+            # The update added this file
+            os.remove(name)
+    os.remove(STATE_FILE)
+
+def confirm():
+    '''
+    Called once the new code is serving, makes the update permanent
+    '''
+    global timer
+    if timer is not None:
+        timer.deinit()
+        timer = None
+    state = load_state()
+    if state is None or state['state'] != 'trial':
+        return
+    for name in state['files']:
+        backup = BACKUP_DIR + '/' + name
+        if exists(backup):
+            os.remove(backup)
+    os.remove(STATE_FILE)
+    print('Update confirmed')
+
+def handle_ota_manifest(app, req, c):
+    c.send(json.dumps(manifest()))
+
+def handle_ota_file(app, req, c):
+    app.receive_file(c, stage_path(req['filename']), req['length'])
+    verify(req['filename'], req['hash'])
+
+def handle_ota_commit(app, req, c):
+    commit(req['files'])
+    c.send(json.dumps({"error": False}))
+    app.handle_reset(req, c)
+
+def trial_expired(timer):
+    import machine
+    if load_state() is not None:
+        print('Update never started serving, rolling back')
+        machine.reset()
+
+def boot():
+    '''
+    Run from boot.py before main.py is imported
+    '''
+    global timer
+    state = load_state()
+    if state is None:
+        return
+    if state['state'] == 'trial':
+        # The last boot ran the new code and it never confirmed
+        print('Rolling back', state['files'])
+        rollback(state['files'])
+        return
+    print('Installing', state['files'])
+    swap(state['files'])
+    state['state'] = 'trial'
+    save_state(state)
+    # If main.py dies before serving there will be nothing left to reset
+    # us, so make sure something does
+    import machine
+    timer = machine.Timer(-1)
+    timer.init(period=TRIAL_MS, mode=machine.Timer.ONE_SHOT,
+            callback=trial_expired)
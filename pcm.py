@@ -0,0 +1,186 @@
+'''
+pcm.py
+Gain, ramping and mixing of signed 16 bit little endian PCM in place
+
+Gains are fixed point with UNITY meaning unchanged, results are clipped
+rather than allowed to wrap. On the device the loops are viper compiled,
+on the host NumPy is used when it is installed.
+'''
+import sys
+
+GAIN_SHIFT = 12
+UNITY = 1 << GAIN_SHIFT
+GAIN_MAX = 8 * UNITY - 1
+
+if sys.implementation.name == 'micropython':
+    import micropython
+
+    @micropython.viper
+    def _gain(buf, n: int, g: int):
+        p = ptr16(buf)
+        i = 0
+        while i < n:
+            s = int(p[i])
+            if s & 0x8000:
+                s -= 0x10000
+            s = (s * g) >> 12
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            p[i] = s
+            i += 1
+
+    @micropython.viper
+    def _ramp(buf, n: int, channels: int, start: int, end: int):
+        p = ptr16(buf)
+        frames = n // channels
+        if frames == 0:
+            return
+        # Whole frames only, a trailing partial one is left alone
+        n = frames * channels
+        # Gain kept with 12 extra bits so small steps still add up
+        acc = start << 12
+        step = ((end - start) << 12) // frames
+        i = 0
+        while i < n:
+            g = acc >> 12
+            c = 0
+            while c < channels:
+                s = int(p[i])
+                if s & 0x8000:
+                    s -= 0x10000
+                s = (s * g) >> 12
+                if s > 32767:
+                    s = 32767
+                elif s < -32768:
+                    s = -32768
+                p[i] = s
+                i += 1
+                c += 1
+            acc += step
+
+    @micropython.viper
+    def _mix(dst, src, n: int, g_dst: int, g_src: int):
+        d = ptr16(dst)
+        s = ptr16(src)
+        i = 0
+        while i < n:
+            a = int(d[i])
+            if a & 0x8000:
+                a -= 0x10000
+            b = int(s[i])
+            if b & 0x8000:
+                b -= 0x10000
+            a = (a * g_dst + b * g_src) >> 12
+            if a > 32767:
+                a = 32767
+            elif a < -32768:
+                a = -32768
+            d[i] = a
+            i += 1
+else:
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None:
+        def _samples(buf, n):
+            return numpy.frombuffer(buf, dtype='<i2', count=n)
+
+        def _gain(buf, n, g):
+            a = _samples(buf, n)
+            a[:] = numpy.clip((a.astype(numpy.int32) * g) >> GAIN_SHIFT,
+                    -32768, 32767)
+
+        def _ramp(buf, n, channels, start, end):
+            a = _samples(buf, n)
+            frames = n // channels
+            g = start + (numpy.arange(frames, dtype=numpy.int32)
+                    * (end - start)) // frames
+            a[:frames * channels] = numpy.clip(
+                    (a[:frames * channels].astype(numpy.int32)
+                        * numpy.repeat(g, channels)) >> GAIN_SHIFT,
+                    -32768, 32767)
+
+        def _mix(dst, src, n, g_dst, g_src):
+            a = _samples(dst, n)
+            b = _samples(src, n)
+            a[:] = numpy.clip((a.astype(numpy.int32) * g_dst
+                + b.astype(numpy.int32) * g_src) >> GAIN_SHIFT,
+                -32768, 32767)
+    else:
+        def _clip(s):
+            return 32767 if s > 32767 else -32768 if s < -32768 else s
+
+        def _gain(buf, n, g):
+            a = memoryview(buf).cast('h')
+            for i in range(n):
+                a[i] = _clip((a[i] * g) >> GAIN_SHIFT)
+
+        def _ramp(buf, n, channels, start, end):
+            a = memoryview(buf).cast('h')
+            frames = n // channels
+            for f in range(frames):
+                g = start + (f * (end - start)) // frames
+                for i in range(f * channels, (f + 1) * channels):
+                    a[i] = _clip((a[i] * g) >> GAIN_SHIFT)
+
+        def _mix(dst, src, n, g_dst, g_src):
+            a = memoryview(dst).cast('h')
+            b = memoryview(src).cast('h')
+            for i in range(n):
+                a[i] = _clip((a[i] * g_dst + b[i] * g_src) >> GAIN_SHIFT)
+
+def _check(g):
+    if g < 0 or g > GAIN_MAX:
+        raise ValueError('Gain %d is outside 0 to %d' % (g, GAIN_MAX))
+    return g
+
+def gain(buf, g):
+    '''
+    Scales every sample in buf by g
+    '''
+    _gain(buf, len(buf) // 2, _check(g))
+
+def ramp(buf, start, end, channels=2):
+    '''
+    Scales buf by a gain moving linearly from start to end, the same for
+    every channel of a frame, so volume changes don't click
+    '''
+    if len(buf) >= 2 * channels:
+        _ramp(buf, len(buf) // 2, channels, _check(start), _check(end))
+
+def mix(dst, src, g_dst=UNITY, g_src=UNITY):
+    '''
+    Adds src scaled by g_src into dst scaled by g_dst, over as many
+    samples as the shorter of the two holds
+    '''
+    _mix(dst, src, min(len(dst), len(src)) // 2, _check(g_dst),
+            _check(g_src))
+
+def bench(seconds=10, rate=44100, channels=2, chunk=2048):
+    '''
+    Times each stage over seconds of audio processed chunk bytes at a
+    time and prints how many times faster than real time it ran
+    '''
+    import os
+    import time
+    total = seconds * rate * channels * 2
+    a = bytearray(os.urandom(chunk))
+    b = bytearray(os.urandom(chunk))
+    for name, f in (
+            ('gain', lambda: gain(a, UNITY // 2)),
+            ('ramp', lambda: ramp(a, 0, UNITY, channels)),
+            ('mix', lambda: mix(a, b, UNITY // 2, UNITY // 2))):
+        start = time.time()
+        for _ in range(total // chunk):
+            f()
+        took = time.time() - start
+        print('%-4s %d s of %d Hz %d channel audio in %.3f s, %.0fx real'
+                ' time' % (name, seconds, rate, channels, took,
+                    seconds / took))
+
+if __name__ == '__main__':
+    bench()
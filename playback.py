@@ -0,0 +1,261 @@
+'''
+playback.py
+Request handlers for controlling and feeding the codec, imported the
+first time one of them is called
+'''
+import json
+from micropython import const
+
+# Largest stream frame, matches RECEIVE_LEN in main.py
+FRAME_LEN = const(2048)
+# Set in a frame's length when it holds a JSON control request instead
+# of audio
+CONTROL = const(0x8000)
+# Largest control request, read into its own buffer so audio received
+# while paused can be held on to
+CONTROL_LEN = const(256)
+# Sample frames a gain is ramped in over so it doesn't click
+RAMP_FRAMES = const(256)
+
+def recv_exact(c, buf, length):
+    mv = memoryview(buf)
+    got = 0
+    while got < length:
+        n = c.readinto(mv[got:], length - got)
+        if not n:
+            raise Exception('Connection closed mid frame')
+        got += n
+
+def control_set_volume(app, req):
+    app.codec().set_volume(int(req['left']), int(req['right']))
+
+def control_set_bass_treble(app, req):
+    app.codec().set_bass_treble(int(req['bass']), int(req['treble']),
+            int(req.get('bass_freq', 60)),
+            int(req.get('treble_freq', 10000)))
+
+def control_pause(app, req):
+    app.codec().pause(bool(req['paused']))
+
+def control_seek(app, req):
+    app.codec().seek(int(req['position']))
+
+# Requests a client may send inside a stream, nothing is sent back
+CONTROLS = {
+        'set_volume': control_set_volume,
+        'set_bass_treble': control_set_bass_treble,
+        'pause': control_pause,
+        'seek': control_seek,
+        }
+
+def handle_set_volume(app, req, c):
+    control_set_volume(app, req)
+
+def handle_set_bass_treble(app, req, c):
+    control_set_bass_treble(app, req)
+
+def stream_control(app, data):
+    req = json.loads(data)
+    f = CONTROLS.get(req.get('action'))
+    if f is None:
+        raise Exception('No such stream control \'%s\''
+                % (req.get('action')))
+    f(app, req)
+
+class Wav(object):
+    '''
+    Scales the samples of a 16 bit PCM WAV stream as frames of any length
+    go by. The header's chunks are passed through untouched, fmt says how
+    many channels there are and samples start after data's header. A
+    sample frame split across two stream frames is held back until the
+    rest of it arrives. The gain ramps up from silence over the first
+    RAMP_FRAMES sample frames however the stream is split.
+    '''
+
+    def __init__(self, gain):
+        import pcm
+        if gain < 0 or gain > pcm.GAIN_MAX:
+            raise Exception('Gain %d is outside 0 to %d'
+                    % (gain, pcm.GAIN_MAX))
+        self.pcm = pcm
+        self.gain = gain
+        # Sample frames of the ramp scaled so far, and the gain it starts at
+        self.ramped = 0
+        self.ramp_from = 0
+        self.channels = 0
+        # Stream offsets of the next frame and of the chunk head starts at
+        self.pos = 0
+        self.next = 0
+        self.head = bytearray()
+        self.carry = None
+        self.carry_mv = None
+        self.carried = 0
+
+    def skip(self, n):
+        self.next += n
+        self.head = self.head[n:]
+
+    def parse(self):
+        '''
+        Walks the chunks in head, True once data's header is in it
+        '''
+        if self.next == 0:
+            if len(self.head) < 12:
+                return False
+            if self.head[:4] != b'RIFF' or self.head[8:12] != b'WAVE':
+                raise Exception('Gain needs a WAV stream')
+            self.skip(12)
+        while len(self.head) >= 8:
+            head = self.head
+            size = head[4] | (head[5] << 8) | (head[6] << 16) | (head[7] << 24)
+            if head[:4] == b'data':
+                if not self.channels:
+                    raise Exception('No fmt chunk before data')
+                return True
+            if head[:4] == b'fmt ':
+                if len(head) < 24:
+                    return False
+                self.channels = head[10] | (head[11] << 8)
+                if not self.channels or head[22] != 16 or head[23] != 0:
+                    raise Exception('Gain needs 16 bit PCM')
+            # Chunks are padded to an even length
+            self.skip(8 + size + (size & 1))
+        return False
+
+    def scale(self, buf, frames):
+        '''
+        Scales whole sample frames, carrying on the ramp from where the
+        last ones left it
+        '''
+        block = 2 * self.channels
+        n = 0
+        if self.ramped < RAMP_FRAMES:
+            n = min(frames, RAMP_FRAMES - self.ramped)
+            change = self.gain - self.ramp_from
+            self.pcm.ramp(buf[:n * block],
+                    self.ramp_from + change * self.ramped // RAMP_FRAMES,
+                    self.ramp_from + change * (self.ramped + n) // RAMP_FRAMES,
+                    self.channels)
+            self.ramped += n
+        if n < frames:
+            self.pcm.gain(buf[n * block:frames * block], self.gain)
+
+    def play(self, codec, mv, length):
+        start = 0
+        if self.head is not None:
+            # Only what's past the end of head is new to it
+            first = self.next + len(self.head) - self.pos
+            if first < length:
+                self.head += mv[max(first, 0):length]
+            self.pos += length
+            if not self.parse():
+                codec.sdi_write(mv[:length])
+                return
+            start = self.next + 8 - (self.pos - length)
+            self.head = None
+            self.carry = bytearray(2 * self.channels)
+            self.carry_mv = memoryview(self.carry)
+        block = len(self.carry)
+        written = 0
+        if self.carried:
+            n = min(block - self.carried, length)
+            self.carry[self.carried:self.carried + n] = mv[:n]
+            self.carried += n
+            if self.carried < block:
+                return
+            self.scale(self.carry_mv, 1)
+            codec.sdi_write(self.carry)
+            self.carried = 0
+            start = n
+            written = n
+        end = length - (length - start) % block
+        if end > start:
+            self.scale(mv[start:end], (end - start) // block)
+        if end > written:
+            codec.sdi_write(mv[written:end])
+        self.carried = length - end
+        self.carry[:self.carried] = mv[end:length]
+
+    def finish(self, codec):
+        # A stream cut off part way through a sample frame
+        if self.carried:
+            codec.sdi_write(self.carry_mv[:self.carried])
+            self.carried = 0
+
+def handle_stream(app, req, c):
+    '''
+    Plays frames of at most FRAME_LEN bytes, each preceded by its length
+    as two big endian bytes, until a zero length frame. A length with
+    CONTROL set is a JSON request from CONTROLS instead of audio, so the
+    client can change volume, pause or seek without leaving the stream.
+    Register updates are written before the next audio frame, so a burst
+    of them costs one write. While paused nothing is written to the codec,
+    a frame that was already on its way is held until playback resumes
+    and the client must send only controls until then.
+
+    If gain is given the stream is taken to be a 16 bit PCM WAV and
+    scaled by it in software, ramping up from silence over the first
+    RAMP_FRAMES sample frames. The WAV header is passed through
+    untouched.
+
+    On error the connection is closed after sending it, the client is
+    still sending audio which can't be read as requests. The track is
+    only reported in status while it plays.
+    '''
+    codec = app.codec()
+    app.track = req.get('name', 'stream')
+    wav = None
+    if req.get('gain') is not None:
+        wav = Wav(int(req['gain']))
+    header = bytearray(2)
+    mv = memoryview(bytearray(FRAME_LEN))
+    ctl = memoryview(bytearray(CONTROL_LEN))
+    held = 0
+    c.send(json.dumps({"ready": True}))
+    try:
+        while True:
+            # Status requests still get an answer while we play
+            app.poll_discovery()
+            recv_exact(c, header, 2)
+            length = (header[0] << 8) | header[1]
+            if length == 0:
+                if wav is not None:
+                    wav.finish(codec)
+                break
+            if length & CONTROL:
+                length &= ~CONTROL
+                if length > CONTROL_LEN:
+                    raise Exception('Control of %d bytes is too large'
+                            % (length))
+                recv_exact(c, ctl, length)
+                stream_control(app, bytes(ctl[:length]))
+                if not held or codec.paused:
+                    continue
+                # Resumed, play what arrived as we paused
+                length = held
+                held = 0
+            else:
+                if length > FRAME_LEN:
+                    raise Exception('Frame of %d bytes is too large'
+                            % (length))
+                if held:
+                    raise Exception('Audio sent while paused')
+                recv_exact(c, mv, length)
+                if codec.paused:
+                    held = length
+                    continue
+            if codec.pending:
+                codec.flush()
+            if wav is None:
+                codec.sdi_write(mv[:length])
+            else:
+                wav.play(codec, mv, length)
+    except Exception as e:
+        try:
+            c.send(json.dumps({"error": str(e)}))
+        except Exception:
+            pass
+        c.close()
+        raise
+    finally:
+        app.track = None
@@ -0,0 +1,301 @@
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+
+RECEIVE_LEN = 2048
+MAGIC = b'RPL2'
+# direction, session, seconds since recording started, payload length
+RECORD = struct.Struct('>BIdI')
+TO_DEVICE = 0
+TO_CLIENT = 1
+
+class Recorder(object):
+    '''
+    Proxies clients to a device and writes everything that passes through
+    to a file with the time it was seen
+    '''
+
+    def __init__(self, listen, device, filename):
+        self.listen = listen
+        self.device = device
+        self.fd = open(filename, 'wb')
+        self.fd.write(MAGIC)
+        self.lock = threading.Lock()
+        self.start = None
+        self.sessions = 0
+
+    def write(self, direction, session, data):
+        with self.lock:
+            self.fd.write(RECORD.pack(direction, session,
+                time.time() - self.start, len(data)))
+            self.fd.write(data)
+            self.fd.flush()
+
+    def pipe(self, src, dst, direction, session):
+        try:
+            while True:
+                data = src.recv(RECEIVE_LEN)
+                if not data:
+                    break
+                self.write(direction, session, data)
+                dst.sendall(data)
+        except OSError:
+            pass
+        # Let the other side see the close too
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def run(self):
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(self.listen)
+        s.listen(1)
+        print('Recording', self.listen, 'to', self.device)
+        try:
+            while True:
+                c, addr = s.accept()
+                if self.start is None:
+                    self.start = time.time()
+                session = self.sessions
+                self.sessions += 1
+                print('Session', session, 'from', addr)
+                d = socket.create_connection(self.device)
+                for args in ((c, d, TO_DEVICE, session),
+                        (d, c, TO_CLIENT, session)):
+                    t = threading.Thread(target=self.pipe, args=args)
+                    t.daemon = True
+                    t.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            s.close()
+            self.fd.close()
+
+def load(filename):
+    '''
+    Returns the records of a recording grouped by session, in the order
+    sessions started
+    '''
+    sessions = {}
+    order = []
+    with open(filename, 'rb') as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise Exception('%s is not a recording' % (filename,))
+        while True:
+            header = fd.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            direction, session, t, length = RECORD.unpack(header)
+            if not session in sessions:
+                sessions[session] = []
+                order.append(session)
+            sessions[session].append((direction, t, fd.read(length)))
+    return [sessions[session] for session in order]
+
+DECODER = json.JSONDecoder()
+
+def split_messages(data, limit=None):
+    '''
+    Takes up to limit complete JSON messages off the front of data, the
+    device sends them back to back. Returns how many were taken and the
+    bytes after them.
+    '''
+    text = data.decode('utf-8', 'replace')
+    count = 0
+    i = 0
+    while limit is None or count < limit:
+        while i < len(text) and text[i].isspace():
+            i += 1
+        if i == len(text):
+            break
+        try:
+            message, i = DECODER.raw_decode(text, i)
+        except ValueError:
+            # Not all here yet
+            break
+        count += 1
+    return count, text[i:].encode('utf-8')
+
+def expect(s, count, buf, quiet):
+    '''
+    Receives until count JSON messages arrived or the device went quiet.
+    buf holds what was received past the last response. Returns how many
+    messages and bytes arrived, when the first byte did, and what was
+    received past the messages.
+    '''
+    messages = 0
+    received = 0
+    first = None
+    s.settimeout(quiet)
+    while True:
+        n, buf = split_messages(buf, count - messages)
+        messages += n
+        if messages >= count:
+            break
+        try:
+            data = s.recv(RECEIVE_LEN)
+        except socket.timeout:
+            break
+        if not data:
+            break
+        if first is None:
+            first = time.time()
+        received += len(data)
+        buf += data
+    return messages, received, first, buf
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def replay_session(records, target, start, paced, quiet, stats):
+    '''
+    Sends the client side of one recorded session and adds what happened
+    to stats
+    '''
+    if paced:
+        time.sleep(max(start + records[0][1] - time.time(), 0))
+    s = socket.create_connection(target)
+    latencies = []
+    sent = 0
+    received = 0
+    mismatches = 0
+    last_send = None
+    buf = b''
+    i = 0
+    while i < len(records):
+        direction, t, data = records[i]
+        if direction == TO_DEVICE:
+            if paced:
+                time.sleep(max(start + t - time.time(), 0))
+            last_send = time.time()
+            s.sendall(data)
+            sent += len(data)
+            i += 1
+            continue
+        # Everything the device sent before the client spoke again is
+        # one response, however the network split it up
+        data = b''
+        while i < len(records) and records[i][0] == TO_CLIENT:
+            data += records[i][2]
+            i += 1
+        count = split_messages(data)[0]
+        got, length, first, buf = expect(s, count, buf, quiet)
+        received += length
+        if got != count:
+            mismatches += 1
+        if first is not None and last_send is not None:
+            latencies.append(first - last_send)
+    s.close()
+    with stats['lock']:
+        stats['latencies'] += latencies
+        stats['sent'] += sent
+        stats['received'] += received
+        stats['mismatches'] += mismatches
+
+def replay(filename, target, paced=True, quiet=1.0):
+    '''
+    Sends the client side of every recorded session to target and times
+    how long each recorded response takes to come back. Paced sessions run
+    side by side starting when they did in the recording, otherwise one
+    after another as fast as possible.
+    '''
+    stats = {'lock': threading.Lock(), 'latencies': [], 'sent': 0,
+            'received': 0, 'mismatches': 0}
+    start = time.time()
+    threads = []
+    for records in load(filename):
+        args = (records, target, start, paced, quiet, stats)
+        if not paced:
+            replay_session(*args)
+            continue
+        t = threading.Thread(target=replay_session, args=args)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    duration = time.time() - start
+    latencies = stats['latencies']
+    sent = stats['sent']
+    received = stats['received']
+    return {
+        'responses': len(latencies),
+        'mismatches': stats['mismatches'],
+        'bytes_sent': sent,
+        'bytes_received': received,
+        'duration': duration,
+        'throughput': (sent + received) / duration if duration else None,
+        'latency_mean': sum(latencies) / len(latencies)
+            if latencies else None,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_max': max(latencies) if latencies else None,
+        }
+
+def compare(before, after):
+    '''
+    Prints each metric of two replay reports and how much it changed
+    '''
+    for k in sorted(before):
+        a = before[k]
+        b = after.get(k)
+        if a is None or b is None:
+            print('%-16s %14s %14s' % (k, a, b))
+        elif a == 0:
+            print('%-16s %14.6g %14.6g' % (k, a, b))
+        else:
+            print('%-16s %14.6g %14.6g %+8.1f%%' % (k, a, b,
+                (b - a) * 100.0 / a))
+
+def parse_server(server):
+    host, port = server.rsplit(':', 1)
+    return (host, int(port))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Record and replay client sessions with a device')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    record = sub.add_parser('record', help='proxy to a device and record')
+    record.add_argument('device', type=parse_server, help='host:port')
+    record.add_argument('filename')
+    record.add_argument('-l', '--listen', type=parse_server,
+            default=('0.0.0.0', 8081), help='host:port to accept clients on')
+    play = sub.add_parser('replay', help='replay a recording')
+    play.add_argument('filename')
+    play.add_argument('-t', '--target', type=parse_server,
+            default=('127.0.0.1', 8080), help='host:port to replay to')
+    play.add_argument('-f', '--fast', action='store_true',
+            help='send as fast as possible instead of at recorded pace')
+    play.add_argument('-q', '--quiet', type=float, default=1.0,
+            help='seconds of silence before a response is given up on')
+    play.add_argument('-o', '--output', help='write the report here')
+    diff = sub.add_parser('compare', help='compare two replay reports')
+    diff.add_argument('before')
+    diff.add_argument('after')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        Recorder(args.listen, args.device, args.filename).run()
+    elif args.command == 'replay':
+        report = replay(args.filename, args.target, not args.fast,
+                args.quiet)
+        # Written first so a closed stdout can't leave an old one behind
+        if args.output:
+            with open(args.output, 'w') as fd:
+                json.dump(report, fd, indent=4, sort_keys=True)
+        print(json.dumps(report, indent=4, sort_keys=True))
+    else:
+        with open(args.before) as a, open(args.after) as b:
+            compare(json.load(a), json.load(b))
+
+if __name__ == '__main__':
+    main()
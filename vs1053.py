@@ -0,0 +1,127 @@
+'''
+vs1053.py
+Drives the VS1053b codec over SPI
+'''
+import machine
+from micropython import const
+
+SCI_WRITE = const(0x02)
+SCI_READ = const(0x03)
+SCI_MODE = const(0x0)
+SCI_BASS = const(0x2)
+SCI_DECODE_TIME = const(0x4)
+SCI_VOL = const(0xB)
+# Attenuation in -0.5 dB steps, 0xFE is silence
+VOL_MAX = const(0xFE)
+# Bytes the decoder is guaranteed to accept each time DREQ is high
+SDI_CHUNK = const(32)
+
+class VS1053(object):
+    '''
+    Reads and writes SCI registers. Register updates are queued and only
+    the latest value for each register is written when flush is called,
+    so a burst of volume changes costs one SPI transaction.
+    '''
+
+    def __init__(self, xcs, xdcs, dreq, spi=1, baudrate=1000000):
+        self.spi = machine.SPI(spi, baudrate=baudrate, polarity=0, phase=0)
+        self.xcs = machine.Pin(xcs, machine.Pin.OUT, value=1)
+        self.xdcs = machine.Pin(xdcs, machine.Pin.OUT, value=1)
+        self.dreq = machine.Pin(dreq, machine.Pin.IN)
+        self.buf = bytearray(4)
+        self.pending = {}
+        self.paused = False
+        self.position = 0
+
+    def wait(self):
+        '''
+        Blocks until the codec can take another command
+        '''
+        while not self.dreq():
+            pass
+
+    def sci_write(self, addr, value):
+        self.wait()
+        b = self.buf
+        b[0] = SCI_WRITE
+        b[1] = addr
+        b[2] = value >> 8
+        b[3] = value & 0xFF
+        self.xcs(0)
+        self.spi.write(b)
+        self.xcs(1)
+
+    def sci_read(self, addr):
+        self.wait()
+        b = self.buf
+        b[0] = SCI_READ
+        b[1] = addr
+        b[2] = 0
+        b[3] = 0
+        self.xcs(0)
+        self.spi.write_readinto(b, b)
+        self.xcs(1)
+        return (b[2] << 8) | b[3]
+
+    def sdi_write(self, data):
+        '''
+        Feeds data to the decoder
+        '''
+        mv = memoryview(data)
+        for i in range(0, len(mv), SDI_CHUNK):
+            self.wait()
+            self.xdcs(0)
+            self.spi.write(mv[i:i + SDI_CHUNK])
+            self.xdcs(1)
+        self.position += len(mv)
+
+    def update(self, addr, value):
+        '''
+        Queues a register write replacing any queued value for the same
+        register
+        '''
+        self.pending[addr] = value
+
+    def flush(self):
+        '''
+        Writes all queued register updates
+        '''
+        for addr in self.pending:
+            self.sci_write(addr, self.pending[addr])
+        self.pending.clear()
+
+    def set_volume(self, left, right):
+        '''
+        Attenuation of each channel in -0.5 dB steps, 0 is loudest
+        '''
+        left = min(max(left, 0), VOL_MAX)
+        right = min(max(right, 0), VOL_MAX)
+        self.update(SCI_VOL, (left << 8) | right)
+
+    def set_bass_treble(self, bass, treble, bass_freq=60, treble_freq=10000):
+        '''
+        bass is 0 to 15 dB of boost below bass_freq Hz, treble is -8 to 7
+        in 1.5 dB steps above treble_freq Hz
+        '''
+        bass = min(max(bass, 0), 15)
+        treble = min(max(treble, -8), 7)
+        bass_freq = min(max(bass_freq // 10, 2), 15)
+        treble_freq = min(max(treble_freq // 1000, 1), 15)
+        self.update(SCI_BASS, ((treble & 0xF) << 12) | (treble_freq << 8)
+                | (bass << 4) | bass_freq)
+
+    def pause(self, paused):
+        '''
+        The codec has no pause of its own, it stops playing when it is no
+        longer fed so whoever feeds SDI checks this
+        '''
+        self.paused = paused
+
+    def seek(self, position):
+        '''
+        Called when the data being fed jumps to byte offset position. The
+        decoder resynchronises on its own, only the decode time needs
+        resetting.
+        '''
+        self.position = position
+        self.update(SCI_DECODE_TIME, 0)